@@ -1,124 +1,335 @@
 #!/usr/bin/env python3
+import ctypes
+import math
 import sys
 import numpy as np
-from OpenGL import GL, GLU
+from OpenGL import GL
 from PySide6.QtWidgets import QApplication, QWidget, QVBoxLayout, QPushButton
 from PySide6.QtOpenGLWidgets import QOpenGLWidget
 from PySide6.QtCore import QTimer
 
 
+def project_points(points, mvp, viewport):
+    # mvp is column-major, so it applies to row vectors from the right;
+    # the homogeneous w=1 column folds into the translation row.
+    x, y, w, h = viewport
+    clip = points @ mvp[:3] + mvp[3]
+    ndc = clip[:, :3] / clip[:, 3:4]
+    winx = x + (ndc[:, 0] * 0.5 + 0.5) * w
+    winy = y + (ndc[:, 1] * 0.5 + 0.5) * h
+    winz = ndc[:, 2] * 0.5 + 0.5
+    px, py = winx.astype(int), winy.astype(int)
+    # frustum cull: off-screen or outside the depth range (incl. behind the eye)
+    inside = (x <= px) & (px < x + w) & (y <= py) & (py < y + h)
+    inside &= (winz >= 0) & (winz <= 1)
+    return px, py, winz, inside
+
+
+def depth_test(depth, rows, cols, winz):
+    # depth is read back as 16-bit unsigned; allow one LSB of quantization slack
+    thresh = np.clip(winz, 0, 1) * 65535.0 - 1.0
+    return depth[rows, cols] < thresh
+
+
 class OcclusionGLWidget(QOpenGLWidget):
+    PLANE_SIZE = 1000.0
+    GRID_STEPS = 20
+
     def __init__(self):
         super().__init__()
-        self.plane_y = None
-        self.test_points = []
-        self.calculated_occlusion = []
+        # keep the framebuffer between paints so a clean repaint can be skipped
+        self.setUpdateBehavior(QOpenGLWidget.UpdateBehavior.PartialUpdate)
+        self._dirty = True
 
-        # orbital camera
-        self.target = np.array([0.0, 0.0, 0.0])
+        self.plane_y = None
+        self.test_points = np.empty((0, 3), dtype=np.float32)
+        self.calculated_occlusion = np.zeros(0, dtype=bool)
+
+        # point positions and per-point colors, uploaded lazily
+        self._points_vbo = None
+        self._colors_vbo = None
+        self._points_dirty = True
+        self._colors_dirty = True
+
+        # wireframe grid at y=0, uploaded once and translated to plane_y
+        self._grid_vbo = None
+        self._grid_lines = self._build_grid(self.PLANE_SIZE, self.GRID_STEPS)
+
+        # double-buffered depth readback
+        self._depth_pbos = None
+        self._depth_pbo_sizes = [0, 0]
+        self._pbo_index = 0
+
+        # orbital camera; position cached in place until azimuth/elevation/distance change
+        self._camera_pos = np.empty(3, dtype=np.float32)
+        self._camera_pos_valid = False
+        self.target = np.zeros(3, dtype=np.float32)
         self.distance = 15.0
         self.azimuth = 45.0
         self.elevation = 25.0
         self.last_mouse_pos = None
 
+        # cached view/projection, stored in GL's column-major layout
+        self._view = None
+        self._proj = None
+        self._mvp = None
+        self._mvp_dirty = True
+        self._test_pending = False
+
     # ---------------- OpenGL ----------------
 
     def initializeGL(self):
         GL.glEnable(GL.GL_DEPTH_TEST)
         GL.glClearColor(0.05, 0.05, 0.08, 1.0)
+        GL.glBlendFunc(GL.GL_SRC_ALPHA, GL.GL_ONE_MINUS_SRC_ALPHA)
+        GL.glPixelStorei(GL.GL_PACK_ALIGNMENT, 1)  # tightly packed 16-bit depth rows
+        GL.glLineWidth(1.0)
+        GL.glPointSize(8.0)
+        self._depth_pbos = GL.glGenBuffers(2)
+        self._depth_pbo_sizes = [0, 0]
+        self._pbo_index = 0
+        self._points_vbo, self._colors_vbo, self._grid_vbo = GL.glGenBuffers(3)
+        self._points_dirty = True
+        self._colors_dirty = True
+        self._dirty = True
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self._grid_vbo)
+        GL.glBufferData(GL.GL_ARRAY_BUFFER, self._grid_lines.nbytes, self._grid_lines, GL.GL_STATIC_DRAW)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
 
     def resizeGL(self, w, h):
         GL.glViewport(0, 0, w, h)
+        self._mvp_dirty = True
+        self._dirty = True
 
     def paintGL(self):
+        if not self._dirty:
+            return
         GL.glClear(GL.GL_COLOR_BUFFER_BIT | GL.GL_DEPTH_BUFFER_BIT)
         if self.plane_y is None:
             return
         self._setup_matrices()
         self._draw_plane()
         self._draw_points()
+        self._dirty = False
+
+        if self._test_pending:
+            self._test_pending = False
+            QTimer.singleShot(0, self, self.run_occlusion_test)
 
     # ---------------- Camera ----------------
 
+    @property
+    def azimuth(self):
+        return self._azimuth
+
+    @azimuth.setter
+    def azimuth(self, value):
+        self._azimuth = value
+        self._invalidate_camera()
+
+    @property
+    def elevation(self):
+        return self._elevation
+
+    @elevation.setter
+    def elevation(self, value):
+        self._elevation = value
+        self._invalidate_camera()
+
+    @property
+    def distance(self):
+        return self._distance
+
+    @distance.setter
+    def distance(self, value):
+        self._distance = value
+        self._invalidate_camera()
+
+    @property
+    def camera_pos(self):
+        # shared buffer, take .copy() to keep a snapshot
+        if not self._camera_pos_valid:
+            az, el = math.radians(self.azimuth), math.radians(self.elevation)
+            c = math.cos(el)
+            pos = self._camera_pos
+            pos[0] = c * math.sin(az)
+            pos[1] = math.sin(el)
+            pos[2] = c * math.cos(az)
+            pos *= self.distance
+            self._camera_pos_valid = True
+        return self._camera_pos
+
+    def _invalidate_camera(self):
+        self._camera_pos_valid = False
+        self._mvp_dirty = True
+
     def _setup_matrices(self):
-        w, h = self.width(), self.height()
+        if self._mvp_dirty:
+            self._update_matrices()
         GL.glMatrixMode(GL.GL_PROJECTION)
-        GL.glLoadIdentity()
-        GLU.gluPerspective(45.0, w / max(1, h), 0.1, 100.0)
-
-        az, el = np.radians(self.azimuth), np.radians(self.elevation)
-        self.camera_pos = np.array([
-            self.distance * np.cos(el) * np.sin(az),
-            self.distance * np.sin(el),
-            self.distance * np.cos(el) * np.cos(az)
-        ])
-
+        GL.glLoadMatrixf(self._proj)
         GL.glMatrixMode(GL.GL_MODELVIEW)
-        GL.glLoadIdentity()
-        GLU.gluLookAt(*self.camera_pos, *self.target, 0, 1, 0)
+        GL.glLoadMatrixf(self._view)
+
+    def _update_matrices(self):
+        w, h = self.width(), self.height()
+        aspect, near, far = w / max(1, h), 0.1, 100.0
+        f = 1.0 / np.tan(np.radians(45.0) / 2)
+        proj = np.array([
+            [f / aspect, 0, 0, 0],
+            [0, f, 0, 0],
+            [0, 0, (far + near) / (near - far), 2 * far * near / (near - far)],
+            [0, 0, -1, 0]
+        ], dtype=np.float32)
+
+        forward = self.target - self.camera_pos
+        forward /= np.linalg.norm(forward)
+        right = np.cross(forward, (0, 1, 0))
+        right /= np.linalg.norm(right)
+        up = np.cross(right, forward)
+        view = np.identity(4, dtype=np.float32)
+        view[0, :3], view[1, :3], view[2, :3] = right, up, -forward
+        view[:3, 3] = -view[:3, :3] @ self.camera_pos
+
+        self._proj = np.ascontiguousarray(proj.T)
+        self._view = np.ascontiguousarray(view.T)
+        self._mvp = self._view @ self._proj
+        self._mvp_dirty = False
 
     # ---------------- Scene ----------------
 
     def _draw_plane(self, alpha=0.25):
-        y, size = self.plane_y, 1000.0
-        steps = 20
-        step_size = size / steps
+        size = self.PLANE_SIZE
+        GL.glPushMatrix()
+        GL.glTranslatef(0.0, self.plane_y, 0.0)
 
         # Translucent fill
         GL.glEnable(GL.GL_BLEND)
-        GL.glBlendFunc(GL.GL_SRC_ALPHA, GL.GL_ONE_MINUS_SRC_ALPHA)
         GL.glColor4f(0.2, 0.6, 0.9, alpha)
         GL.glBegin(GL.GL_QUADS)
-        GL.glVertex3f(-size, y, -size)
-        GL.glVertex3f( size, y, -size)
-        GL.glVertex3f( size, y,  size)
-        GL.glVertex3f(-size, y,  size)
+        GL.glVertex3f(-size, 0.0, -size)
+        GL.glVertex3f( size, 0.0, -size)
+        GL.glVertex3f( size, 0.0,  size)
+        GL.glVertex3f(-size, 0.0,  size)
         GL.glEnd()
         GL.glDisable(GL.GL_BLEND)
 
         # Wireframe
         GL.glColor3f(0.8, 0.8, 0.8)
-        GL.glLineWidth(1.0)
-        GL.glBegin(GL.GL_LINES)
-        for i in range(-steps, steps + 1):
-            x = i * step_size
-            GL.glVertex3f(x, y, -size)
-            GL.glVertex3f(x, y, size)
-            z = i * step_size
-            GL.glVertex3f(-size, y, z)
-            GL.glVertex3f(size, y, z)
-        GL.glEnd()
+        GL.glEnableClientState(GL.GL_VERTEX_ARRAY)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self._grid_vbo)
+        GL.glVertexPointer(3, GL.GL_FLOAT, 0, None)
+        GL.glDrawArrays(GL.GL_LINES, 0, len(self._grid_lines))
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+        GL.glDisableClientState(GL.GL_VERTEX_ARRAY)
+
+        GL.glPopMatrix()
+
+    @staticmethod
+    def _build_grid(size, steps):
+        # lines[axis, tick, endpoint] = (x, 0, z)
+        ticks = np.linspace(-size, size, 2 * steps + 1, dtype=np.float32)
+        lines = np.zeros((2, len(ticks), 2, 3), dtype=np.float32)
+        lines[0, :, :, 0] = ticks[:, np.newaxis]
+        lines[0, :, :, 2] = (-size, size)
+        lines[1, :, :, 0] = (-size, size)
+        lines[1, :, :, 2] = ticks[:, np.newaxis]
+        return lines.reshape(-1, 3)
 
     def _draw_points(self):
-        GL.glPointSize(8.0)
-        GL.glBegin(GL.GL_POINTS)
-        for p, occ in zip(self.test_points, self.calculated_occlusion):
-            GL.glColor3f(1.0, 0.2, 0.2) if occ else GL.glColor3f(0.2, 1.0, 0.2)
-            GL.glVertex3f(*p)
-        GL.glEnd()
+        self._upload_points()
+        GL.glEnableClientState(GL.GL_VERTEX_ARRAY)
+        GL.glEnableClientState(GL.GL_COLOR_ARRAY)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self._points_vbo)
+        GL.glVertexPointer(3, GL.GL_FLOAT, 0, None)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self._colors_vbo)
+        GL.glColorPointer(3, GL.GL_FLOAT, 0, None)
+        GL.glDrawArrays(GL.GL_POINTS, 0, len(self.test_points))
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+        GL.glDisableClientState(GL.GL_COLOR_ARRAY)
+        GL.glDisableClientState(GL.GL_VERTEX_ARRAY)
+
+    def _upload_points(self):
+        if self._points_dirty:
+            GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self._points_vbo)
+            GL.glBufferData(GL.GL_ARRAY_BUFFER, self.test_points.nbytes,
+                            self.test_points, GL.GL_STATIC_DRAW)
+            self._points_dirty = False
+
+        if self._colors_dirty:
+            occ = self.calculated_occlusion[:, np.newaxis]
+            colors = np.where(occ, (1.0, 0.2, 0.2), (0.2, 1.0, 0.2)).astype(np.float32)
+            GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self._colors_vbo)
+            GL.glBufferData(GL.GL_ARRAY_BUFFER, colors.nbytes, colors, GL.GL_DYNAMIC_DRAW)
+            self._colors_dirty = False
+
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
 
     # ---------------- Occlusion ----------------
 
     def run_occlusion_test(self):
+        if self._mvp is None:
+            # nothing rendered yet; run once the first paint is done
+            self._test_pending = True
+            self.update()
+            return
         self.makeCurrent()
-        self.calculated_occlusion.clear()
-        modelview = GL.glGetDoublev(GL.GL_MODELVIEW_MATRIX)
-        projection = GL.glGetDoublev(GL.GL_PROJECTION_MATRIX)
         viewport = GL.glGetIntegerv(GL.GL_VIEWPORT)
 
-        for p in self.test_points:
-            winx, winy, winz = GLU.gluProject(*p, modelview, projection, viewport)
-            x, y, w, h = viewport
-            px, py = int(winx), int(winy)
-
-            if not (x <= px < x + w and y <= py < y + h):
-                self.calculated_occlusion.append(True)
-                continue
+        # Project all points at once with the matrices of the last paint
+        n = len(self.test_points)
+        px, py, winz, inside = project_points(self.test_points, self._mvp, viewport)
 
-            GL.glReadBuffer(GL.GL_COLOR_ATTACHMENT0)
-            depth = GL.glReadPixels(px, py, 1, 1, GL.GL_DEPTH_COMPONENT, GL.GL_FLOAT)
-            self.calculated_occlusion.append(depth[0][0] < winz - 1e-6)
+        occluded = np.ones(n, dtype=bool)
+        if not inside.any():
+            self.calculated_occlusion = occluded
+            self._colors_dirty = True
+            self._dirty = True
+            self.update()
+            return
 
+        # Queue one asynchronous depth read over the bounding box of all
+        # on-screen points into a pixel pack buffer, fenced for polling
+        x0, y0 = px[inside].min(), py[inside].min()
+        bw, bh = px[inside].max() + 1 - x0, py[inside].max() + 1 - y0
+        index = self._pbo_index
+        self._pbo_index ^= 1
+        pbo = self._depth_pbos[index]
+
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, pbo)
+        nbytes = int(bw * bh) * 2
+        if nbytes > self._depth_pbo_sizes[index]:
+            GL.glBufferData(GL.GL_PIXEL_PACK_BUFFER, nbytes, None, GL.GL_STREAM_READ)
+            self._depth_pbo_sizes[index] = nbytes
+        GL.glReadPixels(int(x0), int(y0), int(bw), int(bh),
+                        GL.GL_DEPTH_COMPONENT, GL.GL_UNSIGNED_SHORT, 0)
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, 0)
+        sync = GL.glFenceSync(GL.GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        GL.glFlush()
+
+        readback = (sync, pbo, (int(bh), int(bw)),
+                    py[inside] - y0, px[inside] - x0, winz[inside], inside)
+        QTimer.singleShot(4, self, lambda: self._finish_readback(readback))
+
+    def _finish_readback(self, readback):
+        sync, pbo, shape, rows, cols, winz, inside = readback
+        self.makeCurrent()
+        if GL.glClientWaitSync(sync, 0, 0) == GL.GL_TIMEOUT_EXPIRED:
+            QTimer.singleShot(4, self, lambda: self._finish_readback(readback))
+            return
+        GL.glDeleteSync(sync)
+
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, pbo)
+        ptr = GL.glMapBuffer(GL.GL_PIXEL_PACK_BUFFER, GL.GL_READ_ONLY)
+        depth = np.ctypeslib.as_array(ctypes.cast(ptr, ctypes.POINTER(ctypes.c_uint16)), shape=shape)
+        occluded = np.ones(len(inside), dtype=bool)
+        occluded[inside] = depth_test(depth, rows, cols, winz)
+        GL.glUnmapBuffer(GL.GL_PIXEL_PACK_BUFFER)
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, 0)
+
+        self.calculated_occlusion = occluded
+        self._colors_dirty = True
+        self._dirty = True
         self.update()
 
     # ---------------- Input ----------------
@@ -138,11 +349,13 @@ class OcclusionGLWidget(QOpenGLWidget):
         self.elevation = np.clip(self.elevation + dy * 0.5, -89, 89)
 
         self.last_mouse_pos = pos
+        self._dirty = True
         self.update()
 
     def wheelEvent(self, e):
         self.distance *= 0.9 if e.angleDelta().y() > 0 else 1.1
         self.distance = np.clip(self.distance, 3.0, 50.0)
+        self._dirty = True
         self.update()
 
     # ---------------- Data ----------------
@@ -150,12 +363,15 @@ class OcclusionGLWidget(QOpenGLWidget):
     def generate_test_data(self, n=20):
         np.random.seed(42)
         self.plane_y = np.random.uniform(-2, 2)
-        self.test_points = [np.random.uniform(-5, 5, 3) for _ in range(n)]
-        self.calculated_occlusion = [False] * n  # placeholder
+        self.test_points = np.random.uniform(-5, 5, (n, 3)).astype(np.float32)
+        self.calculated_occlusion = np.zeros(n, dtype=bool)  # placeholder
+        self._points_dirty = True
+        self._colors_dirty = True
+        self._dirty = True
 
     def showEvent(self, event):
         super().showEvent(event)
-        if not any(self.calculated_occlusion):
+        if not self.calculated_occlusion.any():
             QTimer.singleShot(50, self.run_occlusion_test)
 
 